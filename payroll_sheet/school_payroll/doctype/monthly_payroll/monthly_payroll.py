@@ -1,21 +1,25 @@
 # Copyright (c) 2025, Yeshiwas Dagnaw and contributors
 # For license information, please see license.txt
 
-import math
+import functools
+from bisect import bisect_left
+from math import ceil, inf
+
 import frappe
 from frappe.model.document import Document
 
 
 # --- PAYE (Rwanda, monthly brackets) ---
+# Bracket upper limits, and PAYE = slope * g + intercept within each bracket
+_PAYE_BP = (60000.0, 100000.0, 200000.0)
+_PAYE_SLOPE = (0.0, 0.10, 0.20, 0.30)
+_PAYE_INT = (0.0, -6000.0, -16000.0, -36000.0)
+
+
 def _paye_rwanda(gross: float) -> float:
     g = float(gross or 0)
-    if g <= 60000:
-        return 0.0
-    if g <= 100000:
-        return 0.10 * (g - 60000)
-    if g <= 200000:
-        return 4000 + 0.20 * (g - 100000)
-    return 24000 + 0.30 * (g - 200000)
+    i = bisect_left(_PAYE_BP, g)  # a limit itself belongs to the lower bracket
+    return _PAYE_SLOPE[i] * g + _PAYE_INT[i]
 
 
 # --- Given Gross & apply_tax, compute all amounts you want to see ---
@@ -47,55 +51,114 @@ def _calc_all(gross: float, apply_tax: bool = True) -> dict:
     }
 
 
-@frappe.whitelist()
-def rwanda_gross_for_take_home(take_home: float, apply_tax: bool = True, tolerance: float = 1.0, max_iter: int = 60) -> dict:
+# --- Take Home 2 only, for the gross search (same arithmetic as _calc_all, no dict) ---
+def _take_home_2(g: float, apply_tax: bool = True) -> float:
+    paye = _paye_rwanda(g) if apply_tax else 0.0
+    net_salary = g - (paye + 0.08 * g + 0.06 * g + 0.006 * g + 0.003 * g)
+    return net_salary - 0.005 * net_salary
+
+
+# --- Take Home 2 as a piecewise-linear function of Gross ---
+# Within a PAYE bracket every deduction is linear in g, so
+# TH2 = (1 - CBHI) * ((1 - contributions - PAYE slope) * g - PAYE intercept).
+_CONTRIB_RATE = 0.08 + 0.06 + 0.006 + 0.003  # RSSB + maternity, employer and employee
+_CBHI_KEEP = 1 - 0.005
+
+
+def _th2_lines(limits, slopes, intercepts) -> tuple:
     """
-    Find the smallest Gross Pay such that Take Home 2 >= target Take Home (T).
-    Returns a dict with all computed fields (rounded to 0 dec).
-    - apply_tax: whether PAYE applies
-    - tolerance: acceptable absolute difference in RWF in the search
+    Return (TH2 at the bracket's upper limit, slope, intercept) for each bracket,
+    so that TH2 = slope * g + intercept for gross values inside it.
     """
-    T = float(take_home or 0)
-    if T <= 0:
-        vals = _calc_all(0.0, apply_tax=apply_tax)
-        # round outputs for consistent UI
-        for k in vals:
-            vals[k] = round(vals[k], 0)
-        vals["gross_pay"] = 0
-        return vals
+    lines = []
+    for limit, paye_slope, paye_int in zip((*limits, inf), slopes, intercepts):
+        slope = _CBHI_KEEP * (1 - _CONTRIB_RATE - paye_slope)
+        intercept = -_CBHI_KEEP * paye_int
+        lines.append((slope * limit + intercept, slope, intercept))
+    return tuple(lines)
 
-    # Establish an upper bound that guarantees TH2 >= T
-    lo, hi = 0.0, max(T / 0.55, 200000.0)  # heuristic start
-    for _ in range(30):
-        if _calc_all(hi, apply_tax=apply_tax)["take_home_2"] >= T:
-            break
-        hi *= 2.0
-
-    # Binary search for minimal gross meeting the target
-    for _ in range(max_iter):
-        mid = (lo + hi) / 2.0
-        th2 = _calc_all(mid, apply_tax=apply_tax)["take_home_2"]
-        if abs(th2 - T) <= tolerance:
-            hi = mid  # tighten upper bound
+
+_TH2_LINES = _th2_lines(_PAYE_BP, _PAYE_SLOPE, _PAYE_INT)
+_TH2_LINES_NO_TAX = _th2_lines((), (0.0,), (0.0,))
+
+
+def _solve_gross(T: float, apply_tax: bool) -> int:
+    """
+    Smallest whole-RWF Gross whose Take Home 2 is at least T (T > 0).
+    Pure float arithmetic on the module tables, no Frappe objects.
+    """
+    # TH2 is strictly increasing in Gross: pick the bracket containing T and invert its line
+    lines = _TH2_LINES if apply_tax else _TH2_LINES_NO_TAX
+    for th2_limit, slope, intercept in lines:
+        if T <= th2_limit:
             break
-        if th2 < T:
-            lo = mid
-        else:
-            hi = mid
+    g = ceil((T - intercept) / slope)
 
-    # Round up to whole RWF and ensure TH2 >= T
-    g = math.ceil(hi)
-    vals = _calc_all(g, apply_tax=apply_tax)
-    while vals["take_home_2"] < T:
+    # Guard against float error so g is the smallest whole RWF with TH2 >= T
+    while _take_home_2(g, apply_tax) < T:
         g += 1
-        vals = _calc_all(g, apply_tax=apply_tax)
+    while g > 0 and _take_home_2(g - 1, apply_tax) >= T:
+        g -= 1
+    return g
+
+
+# --- Round half away from zero to whole RWF ---
+def _round_rwf(x: float) -> int:
+    return int(x + 0.5) if x >= 0 else -int(0.5 - x)
+
+
+# Order of the amounts returned by _rwanda_gross_for_take_home_cached
+_RESULT_FIELDS = ("gross_pay", "paye", "rssb_employer", "rssb_employee", "maternity_employer",
+                  "maternity_employee", "net_salary", "cbhi", "take_home_2")
+
+
+@functools.lru_cache(maxsize=4096)
+def _rwanda_gross_for_take_home_cached(take_home: int, apply_tax: bool) -> tuple:
+    """
+    Solve the gross for a whole-RWF target Take Home and return the amounts
+    in _RESULT_FIELDS order, rounded to whole RWF. Payroll rows often share the
+    same target, so results are memoized.
+    """
+    T = take_home
+    if T <= 0:
+        vals = _calc_all(0.0, apply_tax=apply_tax)
+        vals["gross_pay"] = 0
+        return tuple(_round_rwf(vals[k]) for k in _RESULT_FIELDS)
+
+    g = _solve_gross(T, apply_tax)
 
     # Final rounding to integers for storage
+    vals = _calc_all(g, apply_tax=apply_tax)
     vals["gross_pay"] = g
-    for k in ("paye", "rssb_employer", "rssb_employee", "maternity_employer",
-              "maternity_employee", "net_salary", "cbhi", "take_home_2"):
-        vals[k] = round(vals[k], 0)
-    return vals
+    return tuple(_round_rwf(vals[k]) for k in _RESULT_FIELDS)
+
+
+def _rwanda_gross_for_take_home_batch(take_homes: list, apply_tax: bool = True) -> list:
+    """
+    Solve a whole column of target Take Home amounts at once.
+    Each distinct target is solved a single time; returns one tuple per target
+    in _RESULT_FIELDS order.
+    """
+    targets = [ceil(float(t or 0)) for t in take_homes]
+    solved = {T: _rwanda_gross_for_take_home_cached(T, apply_tax) for T in set(targets)}
+    return [solved[T] for T in targets]
+
+
+@frappe.whitelist()
+def rwanda_gross_for_take_home(take_home: float, apply_tax: bool = True) -> dict:
+    """
+    Find the smallest Gross Pay such that Take Home 2 >= target Take Home (T).
+    Returns a dict with all computed fields (rounded to 0 dec).
+    - take_home: rounded up to whole RWF before solving
+    - apply_tax: whether PAYE applies
+    """
+    T = ceil(float(take_home or 0))
+    return dict(zip(_RESULT_FIELDS, _rwanda_gross_for_take_home_cached(T, bool(apply_tax))))
+
+
+# Employee types shown in the summary, in display order
+_EMP_TYPES = ("Academic", "Administrative", "Support")
+_EMP_TYPE_INDEX = {t: i for i, t in enumerate(_EMP_TYPES)}
 
 
 class MonthlyPayroll(Document):
@@ -106,27 +169,29 @@ class MonthlyPayroll(Document):
         self.get_advance_pay()
 
         # Calculate every child row using gross-checking against Take Home (target TH2)
-        for row in (self.payroll_detail or []):  # child table fieldname
-            self.calculate_row(row)
-
-        # No duplicate employees within the same Monthly Payroll
-        self.validate_duplicates()
+        self.calculate_rows()
 
-        self.calculate_summary()
-        self.calculate_totals()
+        # Summary and totals; also rejects duplicate employees within the same Monthly Payroll
+        self._aggregate()
 
     def check_unique_company_month_year(self):
         if not self.company or not self.month or not self.year:
             return  # skip if any field is empty
-        exists = frappe.db.exists(
-            "Monthly Payroll",
-            {
-                "company": self.company,
-                "month": self.month,
-                "year": self.year,
-                "name": ["!=", self.name],  # exclude current document
-            },
-        )
+        if not self.is_new() and not any(
+            self.has_value_changed(field) for field in ("company", "month", "year")
+        ):
+            return  # already checked when these fields were last saved
+        # Lookups are cached for the rest of the request, keyed on the fields checked
+        cache = frappe.local.flags.setdefault("monthly_payroll_duplicate_cache", {})
+        key = (self.company, self.month, self.year)
+        if key not in cache:
+            cache[key] = frappe.get_all(
+                "Monthly Payroll",
+                filters={"company": self.company, "month": self.month, "year": self.year},
+                pluck="name",
+                limit=2,
+            )
+        exists = any(name != self.name for name in cache[key])  # exclude current document
         if exists:
             frappe.throw(
                 f"A payroll for Company <b>'{self.company}'</b>, Month <b>'{self.month}'</b> and Year <b>'{self.year}'</b> already exists."
@@ -155,9 +220,25 @@ class MonthlyPayroll(Document):
             else:
                 row.advance_pay = 0
     
-    def calculate_row(self, row):
-        target_th = float(row.take_home or 0)
+    def calculate_rows(self):
+        """
+        Solve the gross for all taxed rows in one batch, then fill in each row.
+        """
+        rows = self.payroll_detail or []  # child table fieldname
+        # Read each row's inputs once
+        inputs = [(float(row.take_home or 0), bool(row.apply_tax)) for row in rows]
+        solved = _rwanda_gross_for_take_home_batch(
+            [target_th if apply_tax else 0 for target_th, apply_tax in inputs]
+        )
+        for row, (target_th, apply_tax), vals in zip(rows, inputs, solved):
+            self.calculate_row(row, target_th, apply_tax, vals)
 
+    def calculate_row(self, row, target_th, apply_tax, vals):
+        """
+        Fill in a row's amounts from its Take Home and Apply Tax. `vals` is the
+        solved tuple (in _RESULT_FIELDS order) for the row's Take Home, used when
+        Apply Tax is ON.
+        """
         # --- CASE 1: No Take Home entered ---
         if target_th <= 0:
             row.gross_pay = 0
@@ -172,7 +253,7 @@ class MonthlyPayroll(Document):
             return
 
         # --- CASE 2: Apply Tax = OFF ---
-        if not bool(row.apply_tax):
+        if not apply_tax:
             # Gross = Take Home = Take Home 2
             row.gross_pay = target_th
             row.net_salary = target_th
@@ -188,107 +269,96 @@ class MonthlyPayroll(Document):
             return
 
         # --- CASE 3: Apply Tax = ON (normal calculations) ---
-        vals = rwanda_gross_for_take_home(
-            take_home=target_th,
-            apply_tax=True,
-            tolerance=1.0,
-            max_iter=60,
-        )
-
         # Push values back to the row
-        row.gross_pay = vals["gross_pay"]
-        row.paye = vals["paye"]
-        row.rssb_employer = vals["rssb_employer"]
-        row.rssb_employee = vals["rssb_employee"]
-        row.maternity_employer = vals["maternity_employer"]
-        row.maternity_employee = vals["maternity_employee"]
-        row.net_salary = vals["net_salary"]
-        row.cbhi = vals["cbhi"]
-        row.take_home_2 = vals["take_home_2"]
-
-
-    def validate_duplicates(self):
-        seen = set()
-        for row in (self.payroll_detail or []):
-            if row.employee:
-                if row.employee in seen:
-                    frappe.throw(f"Employee <b>'{row.employee}' </b> is added more than once in this Monthly Payroll.")
-                seen.add(row.employee)
-
-    def calculate_summary(self):
-        summary = {}
-        
-        # Initialize summary for each type
-        types = ["Academic", "Administrative", "Support"]
-        for t in types:
-            summary[t] = {
-                "employee_type": t,
-                "employee_count": 0,
-                "advance_pay": 0,
-                "take_home": 0,  # renamed from net_salary
-                "net_minus_advance": 0,  # will recalc later
-                "cost_to_company": 0
-            }
+        for fieldname, value in zip(_RESULT_FIELDS, vals):
+            setattr(row, fieldname, value)
 
-        # Aggregate data from payroll_detail
-        for row in self.payroll_detail:
-            t = row.employee_type
-            if t in summary:
-                summary[t]["employee_count"] += 1
-                summary[t]["advance_pay"] +=  row.advance_pay or 0
-                summary[t]["take_home"] += row.take_home or 0  # Net Salary becomes Take Home in summary
-                summary[t]["cost_to_company"] += (row.gross_pay or 0) 
-
-        # Calculate Net - Advance (Take Home - Advance Pay) and total row
-        total = {
-            "employee_type": "Total",
-            "employee_count": 0,
-            "advance_pay": 0,
-            "take_home": 0,
-            "net_minus_advance": 0,
-            "cost_to_company": 0
-        }
-
-        self.summary_by_type = []  # clear existing child table
-
-        for t, data in summary.items():
-            data["net_minus_advance"] = data["take_home"] - data["advance_pay"]
-            self.append("summary_by_type", data)
-            for key in total:
-                if key in data and isinstance(data[key], (int, float)):
-                    total[key] += data[key]
-
-        total["net_minus_advance"] = total["take_home"] - total["advance_pay"]
-        self.append("summary_by_type", total)
-
-    def calculate_totals(self):
+    def _aggregate(self):
         """
-        Calculate totals for the entire payroll month.
+        Build the summary by employee type and the totals for the entire payroll
+        month in a single pass over payroll_detail, rejecting any employee added
+        more than once along the way.
         """
+        seen_employees = set()
+
+        # Per-type accumulators, indexed by position in _EMP_TYPES
+        counts = [0] * len(_EMP_TYPES)
+        advances = [0] * len(_EMP_TYPES)
+        take_homes = [0] * len(_EMP_TYPES)  # renamed from net_salary
+        costs = [0] * len(_EMP_TYPES)
+
         total_cost = 0
         advance_pay = 0
         take_home = 0
-        net_advance = 0
         total_paye = 0
         total_rssb = 0
         total_maternity = 0
         total_cbhi = 0
 
+        # Aggregate data from payroll_detail
         for row in self.payroll_detail:
-            total_cost += row.gross_pay or 0
-            advance_pay += row.advance_pay or 0
-            take_home += row.take_home or 0
-            total_paye += row.paye or 0
-            total_rssb += (row.rssb_employee or 0) + (row.rssb_employer or 0)
-            total_maternity += (row.maternity_employee or 0) + (row.maternity_employer or 0)
-            total_cbhi += row.cbhi or 0
+            emp = row.employee
+            if emp:
+                if emp in seen_employees:
+                    frappe.throw(f"Employee <b>'{emp}' </b> is added more than once in this Monthly Payroll.")
+                seen_employees.add(emp)
+
+            # Read each field once into locals
+            gp = row.gross_pay or 0
+            adv = row.advance_pay or 0
+            th = row.take_home or 0
+            paye = row.paye or 0
+            rssb_e = row.rssb_employee or 0
+            rssb_r = row.rssb_employer or 0
+            mat_e = row.maternity_employee or 0
+            mat_r = row.maternity_employer or 0
+            cbhi = row.cbhi or 0
+            et = row.employee_type
+
+            i = _EMP_TYPE_INDEX.get(et)
+            if i is not None:
+                counts[i] += 1
+                advances[i] += adv
+                take_homes[i] += th  # Net Salary becomes Take Home in summary
+                costs[i] += gp
+
+            total_cost += gp
+            advance_pay += adv
+            take_home += th
+            total_paye += paye
+            total_rssb += rssb_e + rssb_r
+            total_maternity += mat_e + mat_r
+            total_cbhi += cbhi
+
+        # Calculate Net - Advance (Take Home - Advance Pay), one row per type plus the total row
+        summary = [
+            {
+                "employee_type": t,
+                "employee_count": counts[i],
+                "advance_pay": advances[i],
+                "take_home": take_homes[i],
+                "net_minus_advance": take_homes[i] - advances[i],
+                "cost_to_company": costs[i],
+            }
+            for i, t in enumerate(_EMP_TYPES)
+        ]
+        summary.append({
+            "employee_type": "Total",
+            "employee_count": sum(counts),
+            "advance_pay": sum(advances),
+            "take_home": sum(take_homes),
+            "net_minus_advance": sum(take_homes) - sum(advances),
+            "cost_to_company": sum(costs),
+        })
 
         net_advance = take_home - advance_pay
         total_taxes = total_paye + total_rssb + total_maternity + total_cbhi
 
-        # Clear and append to the child table
-        self.monthly_payroll_totals = []
-        self.append("monthly_payroll_totals", {
+        # Replace the existing child tables in one go
+        self.summary_by_type = self.make_child_rows(
+            "summary_by_type", "Monthly Payroll Summary", summary
+        )
+        self.monthly_payroll_totals = self.make_child_rows("monthly_payroll_totals", "Monthly Payroll Totals", [{
             "total_cost": total_cost,
             "advance_pay": advance_pay,
             "take_home": take_home,
@@ -298,10 +368,40 @@ class MonthlyPayroll(Document):
             "total_maternity": total_maternity,
             "total_cbhi": total_cbhi,
             "total_taxes": total_taxes
-        })
+        }])
+
+    def make_child_rows(self, parentfield, doctype, rows):
+        """
+        Build child table documents directly from dicts, so a whole table can be
+        assigned at once instead of going through self.append row by row.
+        """
+        return [
+            frappe.get_doc({
+                "doctype": doctype,
+                "parent": self.name,
+                "parenttype": self.doctype,
+                "parentfield": parentfield,
+                "idx": idx,
+                **data,
+            })
+            for idx, data in enumerate(rows, start=1)
+        ]
+
     def before_save(self):
         self.sort_payroll_detail_by_employee_name()
 
+    def on_update(self):
+        self.clear_duplicate_payroll_cache()
+
+    def on_trash(self):
+        self.clear_duplicate_payroll_cache()
+
+    def clear_duplicate_payroll_cache(self):
+        """
+        Drop the cached Company + Month + Year lookups once this payroll has been written.
+        """
+        frappe.local.flags.pop("monthly_payroll_duplicate_cache", None)
+
     def sort_payroll_detail_by_employee_name(self):
         if not self.payroll_detail:
             return
@@ -8,23 +8,48 @@ class Payment(Document):
     def validate(self):
         self.check_duplicate_payment()
 
+    def on_update(self):
+        self.clear_duplicate_payment_cache()
+
+    def on_cancel(self):
+        self.clear_duplicate_payment_cache()
+
+    def on_trash(self):
+        self.clear_duplicate_payment_cache()
+
+    def clear_duplicate_payment_cache(self):
+        """
+        Drop the cached duplicate lookups once this payment has been written.
+        """
+        frappe.local.flags.pop("payment_duplicate_cache", None)
+
     def check_duplicate_payment(self):
         """
         Ensure the same employee does not have a payment in the same year and payroll month.
         """
         if not self.employee or not self.year or not self.payroll_month:
             return  # skip if any field is empty
+        if not self.is_new() and not any(
+            self.has_value_changed(field) for field in ("employee", "year", "payroll_month")
+        ):
+            return  # already checked when these fields were last saved
 
-        exists = frappe.db.exists(
-            "Payment",
-            {
-                "employee": self.employee,
-                "year": self.year,
-                "payroll_month": self.payroll_month,
-                "docstatus":["!=", 2], # Execlude Cancelled documents
-                "name": ["!=", self.name]  # exclude current document
-            }
-        )
+        # Lookups are cached for the rest of the request, keyed on the fields checked
+        cache = frappe.local.flags.setdefault("payment_duplicate_cache", {})
+        key = (self.employee, self.year, self.payroll_month)
+        if key not in cache:
+            cache[key] = frappe.get_all(
+                "Payment",
+                filters={
+                    "employee": self.employee,
+                    "year": self.year,
+                    "payroll_month": self.payroll_month,
+                    "docstatus": ["!=", 2],  # Execlude Cancelled documents
+                },
+                pluck="name",
+                limit=2,
+            )
+        exists = any(name != self.name for name in cache[key])  # exclude current document
         if exists:
             frappe.throw(
                 f"Employee <b>'{self.employee}' </b> already has a payment recorded for <b>{self.payroll_month} {self.year}</b>."